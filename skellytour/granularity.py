@@ -0,0 +1,85 @@
+import os
+import logging
+import numpy as np
+import SimpleITK as sitk
+
+## The labelling schemes are hierarchical; every high label falls entirely within one medium label,
+## and every medium label falls entirely within one low label
+## See the label list in the README for the meaning of each number
+## Order of models from coarsest to finest, and the number of labels in each
+MODELS=["low","medium","high"]
+NLABELS={"low":17,"medium":38,"high":60}
+
+## high to medium: left ribs 1-12 (12-23) become LEFT_RIBS (12), right ribs 1-12 (24-35) become RIGHT_RIBS (13),
+## vertebrae C1-L5 (36-59) move down to 14-37 and ARTIFACTS (60) becomes 38
+HIGH_TO_MEDIUM=np.zeros(NLABELS["high"]+1,dtype=np.uint8)
+HIGH_TO_MEDIUM[1:12]=range(1,12)
+HIGH_TO_MEDIUM[12:24]=12
+HIGH_TO_MEDIUM[24:36]=13
+HIGH_TO_MEDIUM[36:60]=range(14,38)
+HIGH_TO_MEDIUM[60]=38
+
+## medium to low: C1-C7 (14-20) become CERVICAL_VERTEBRAE (14), T1-T12 (21-32) become THORACIC_VERTEBRAE (15),
+## L1-L5 (33-37) become LUMBAR_VERTEBRAE (16) and ARTIFACTS (38) becomes 17
+MEDIUM_TO_LOW=np.zeros(NLABELS["medium"]+1,dtype=np.uint8)
+MEDIUM_TO_LOW[1:14]=range(1,14)
+MEDIUM_TO_LOW[14:21]=14
+MEDIUM_TO_LOW[21:33]=15
+MEDIUM_TO_LOW[33:38]=16
+MEDIUM_TO_LOW[38]=17
+
+def finest(models):
+    ## Return the model with the most labels from a list of model names
+    return(max(models,key=MODELS.index))
+
+def lookup_table(frommodel,tomodel):
+    ## Build a lookup table mapping labels of frommodel to labels of tomodel, which must be the same or coarser
+    if MODELS.index(tomodel)>MODELS.index(frommodel):
+        raise ValueError("Cannot derive "+tomodel+" labels from the coarser "+frommodel+" model")
+    lut=np.arange(NLABELS[frommodel]+1,dtype=np.uint8)
+    if frommodel=="high" and tomodel!="high":
+        lut=HIGH_TO_MEDIUM[lut]
+    if tomodel=="low" and frommodel!="low":
+        lut=MEDIUM_TO_LOW[lut]
+    return(lut)
+
+def derive_segmentation(segmentation_filename,frommodel,tomodel,output_filename):
+    ## Remap a segmentation to a coarser labelling scheme and write it with the same geometry
+    ## Relabelling is voxelwise, so no reorientation is needed
+    image=sitk.ReadImage(segmentation_filename)
+    narr=sitk.GetArrayViewFromImage(image)
+    if narr.max()>NLABELS[frommodel]:
+        raise ValueError("Segmentation "+segmentation_filename+" contains labels not in the "+frommodel+" model")
+    derived=sitk.GetImageFromArray(lookup_table(frommodel,tomodel)[narr])
+    derived.CopyInformation(image)
+    sitk.WriteImage(derived,output_filename)
+
+def dice_scores(narr1,narr2,nlabels):
+    ## Dice score for every label (excluding background) between two label arrays
+    ## Labels absent from both arrays are NaN
+    ## A joint histogram gives every label's intersection in a single pass over the data
+    joint=np.bincount(narr1.ravel().astype(np.int64)*(nlabels+1)+narr2.ravel(),minlength=(nlabels+1)**2)
+    joint=joint.reshape(nlabels+1,nlabels+1)
+    intersection=np.diag(joint)[1:]
+    total=joint.sum(axis=1)[1:]+joint.sum(axis=0)[1:]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        dice=2*intersection/total
+    return(dice)
+
+def segmentation_agreement(filename1,filename2,model):
+    ## Compare two segmentations using the labels of the same model and log the results
+    ## e.g. a derived segmentation against one predicted directly by the coarser model
+    ## Returns the mean Dice over labels present in either segmentation
+    narr1=sitk.GetArrayFromImage(sitk.ReadImage(filename1))
+    narr2=sitk.GetArrayFromImage(sitk.ReadImage(filename2))
+    if narr1.shape!=narr2.shape:
+        raise ValueError("Segmentations have different dimensions: "+str(narr1.shape)+" and "+str(narr2.shape))
+    dice=dice_scores(narr1,narr2,NLABELS[model])
+    for seglabel,score in enumerate(dice,start=1):
+        if not np.isnan(score):
+            logging.info("Agreement for "+model+" label "+str(seglabel)+": Dice "+str(round(score,4)))
+    meandice=float(np.nanmean(dice)) if not np.all(np.isnan(dice)) else float("nan")
+    voxelagreement=float(np.mean(narr1==narr2))
+    logging.info("Agreement between "+os.path.basename(filename1)+" and "+os.path.basename(filename2)+": mean Dice "+str(round(meandice,4))+
+        ", voxelwise agreement "+str(round(voxelagreement,4)))
+    return(meandice)
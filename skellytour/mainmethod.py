@@ -36,6 +36,8 @@ from skellytour.nnunetv2_setup import nnunetv2_setup, nnunetv2_weights
 from skellytour.nnunetv2_predict import predict_case 
 from skellytour.postprocessing import postprocessing
 from skellytour.subseg_postprocessing import subsegpostprocessing
+from skellytour.orientation import reorient_image
+from skellytour.granularity import MODELS, finest, derive_segmentation, segmentation_agreement
 
 def exitlog(starttime):
     endtime=datetime.datetime.now()
@@ -83,8 +85,26 @@ def main():
     parser.add_argument("--nopp", help="skip postprocessing on predicted segmentations", required=False, default=False, action='store_true')
     parser.add_argument("--subseg", help="perform subsegmentation, to predict trabecular and cortical labels", required=False, default=False, action='store_true')
     parser.add_argument("--fast", help="perform segmentation tasks with a single fold, not the full ensemble model. Not recommended", required=False, default=False, action='store_true')
+    parser.add_argument("--derive", type=str, nargs="+", help="additional models to produce; only the finest of these and -m is predicted, coarser models are derived from it by relabelling", required=False, default=[], choices=MODELS)
+    parser.add_argument("--localize", help="two-stage prediction; a fast single fold low model localizes the skeleton, then the requested model only predicts tiles near it", required=False, default=False, action='store_true')
+    parser.add_argument("--localizemargin", type=float, help="distance in mm around the localized skeleton to include in the second stage of --localize", required=False, default=20.0)
+    parser.add_argument("--localizecheck", help="also predict the full volume without localization and report its agreement with the localized prediction", required=False, default=False, action='store_true')
+    parser.add_argument("--derivecheck", help="also predict derived models directly and report their agreement with the derived segmentations", required=False, default=False, action='store_true')
     args=parser.parse_args()
 
+    ## Check arguments that only make sense together
+    if args.localizemargin<0:
+        parser.error("--localizemargin must be 0 or greater")
+    if not args.localize and (args.localizecheck or args.localizemargin!=parser.get_default("localizemargin")):
+        parser.error("--localizecheck and --localizemargin can only be used with --localize")
+
+    ## If other models are requested, predict only the finest and derive the coarser ones from it
+    ## args.m becomes the predicted model; the model requested with -m is kept for subsegmentation
+    requestedmodel=args.m
+    models=set([args.m]+args.derive)
+    args.m=finest(models)
+    derivedmodels=[model for model in MODELS if model in models and model!=args.m]
+
     ## Turn arguments into a nice string for printing
     printargs=str(sys.argv).replace(",","").replace("'","").replace("[","").replace("]","")
 
@@ -118,6 +138,8 @@ def main():
     logging.info("Input file is: "+str(args.i))
     logging.info("Output directory is: "+str(args.o))
     logging.info("Model used is: "+str(args.m))
+    if derivedmodels:
+        logging.info("Models derived from "+str(args.m)+" model: "+", ".join(derivedmodels))
     logging.info("CPU cores used for pre/postprocessing: "+str(args.c))
 
     ## Determine which compute device to use for prediction
@@ -180,7 +202,9 @@ def main():
     ## Set up input variables for main prediction
     samplename=os.path.basename(args.i)[:-7]
     segmentation_filename=os.path.join(args.o,samplename+"_"+args.m+".nii.gz")
-    postprocessed_filename=segmentation_filename[:-7]+"_postprocessed.nii.gz"
+    ## Subsegmentation uses the postprocessed output of the model requested with -m, which may be derived
+    requested_filename=os.path.join(args.o,samplename+"_"+requestedmodel+".nii.gz")
+    postprocessed_filename=requested_filename[:-7]+"_postprocessed.nii.gz"
 
     ## Set up folds; if --fast is used, use only the 0th fold
     if args.fast:
@@ -192,7 +216,7 @@ def main():
     ## Get model and set up input variables for subsegmentation
     if args.subseg:
         subsegmodel_folder_name,sugbseguse_mirroring=nnunetv2_weights("subseg",nnunetdir)
-        subseg_filename=segmentation_filename[:-7]+"_postprocessed_subseg.nii.gz"
+        subseg_filename=requested_filename[:-7]+"_postprocessed_subseg.nii.gz"
         subseg_postprocessed_filename=subseg_filename[:-7]+"_postprocessed.nii.gz"
 
     ## Avoid overwriting if output exists
@@ -202,29 +226,91 @@ def main():
     else:
         ## Copy input file to output directory and change orientation to standard
         logging.info("Copying input data to temporary file in output directory")
-        reader=sitk.ImageFileReader()
-        reader.SetFileName(args.i)
-        image = reader.Execute()
+        ## The input image has already been read above, so reuse it rather than reading it again
         inputorientation = sitk.DICOMOrientImageFilter_GetOrientationFromDirectionCosines(image.GetDirection())
-        image = sitk.DICOMOrient(image, desiredCoordinateOrientation="LPS")
+        image = reorient_image(image, "LPS")
         sitk.WriteImage(image,os.path.join(args.o,"temp.nii.gz"))
         logging.info("Input file orientation: "+str(inputorientation))
+        ## Localize the skeleton with a fast first pass: low model, single fold and non-overlapping tiles
+        localization_mask=None
+        if args.localize:
+            coarsemodel_folder_name,coarseuse_mirroring=nnunetv2_weights("low",nnunetdir)
+            coarse_filename=os.path.join(args.o,"temp_coarse.nii.gz")
+            logging.info("Localization prediction starting")
+            coarsestarttime=datetime.datetime.now()
+            predict_case(args=args,model_folder_name=coarsemodel_folder_name,folds=(0,),
+                output_filenames=[coarse_filename],use_mirroring=coarseuse_mirroring,tile_step_size=1)
+            localization_mask=sitk.GetArrayFromImage(sitk.ReadImage(coarse_filename))>0
+            coarsetime=datetime.datetime.now()-coarsestarttime
+            logging.info("Localization prediction complete, time taken: "+str(coarsetime))
+            logging.info("Localized skeleton occupies "+str(round(100*localization_mask.mean(),1))+"% of the input volume")
         ## Do prediction
         logging.info("Prediction starting")
-        predict_case(args=args,model_folder_name=model_folder_name,folds=folds,
-            output_filenames=[segmentation_filename],use_mirroring=use_mirroring)
+        predictionstarttime=datetime.datetime.now()
+        timesaved=predict_case(args=args,model_folder_name=model_folder_name,folds=folds,
+            output_filenames=[segmentation_filename],use_mirroring=use_mirroring,
+            localization_mask=localization_mask,localization_margin=args.localizemargin)
+        predictiontime=datetime.datetime.now()-predictionstarttime
         logging.info("Prediction complete, output is: "+str(segmentation_filename))
+        logging.info("Prediction time taken: "+str(predictiontime))
+        ## The net saving of localization is the time saved by skipping tiles minus the localization pass
+        if args.localize and timesaved is not None:
+            nettimesaved=timesaved-coarsetime.total_seconds()
+            logging.info("Estimated net time saved by localization, after the localization pass: "+str(round(nettimesaved,1))+" seconds")
+            if nettimesaved<0:
+                logging.warning("Localization took longer than the time it saved; consider running without --localize")
+        ## Predict the full volume without localization and compare
+        if args.localize and args.localizecheck:
+            fullvolume_filename=segmentation_filename[:-7]+"_fullvolume.nii.gz"
+            logging.info("Predicting full volume for comparison with localized prediction")
+            fullvolumestarttime=datetime.datetime.now()
+            predict_case(args=args,model_folder_name=model_folder_name,folds=folds,
+                output_filenames=[fullvolume_filename],use_mirroring=use_mirroring)
+            logging.info("Full volume prediction complete, output is: "+str(fullvolume_filename))
+            fullvolumetime=datetime.datetime.now()-fullvolumestarttime
+            logging.info("Full volume prediction time taken: "+str(fullvolumetime))
+            logging.info("Measured net time saved by localization: "+str(round((fullvolumetime-coarsetime-predictiontime).total_seconds(),1))+" seconds")
+            segmentation_agreement(segmentation_filename,fullvolume_filename,args.m)
 
-    ## Perform postprocessing if desired and segmentation completed
-    if not args.nopp and os.path.exists(segmentation_filename):
-        ## Avoid overwriting if output exists
-        if not args.overwrite and os.path.exists(postprocessed_filename):
-            logging.info("Postprocessed output already exists: "+str(postprocessed_filename))
+    ## Derive coarser segmentations from the prediction by relabelling
+    for model in derivedmodels:
+        derived_filename=os.path.join(args.o,samplename+"_"+model+".nii.gz")
+        if not args.overwrite and os.path.exists(derived_filename):
+            logging.info("Derived "+model+" segmentation already exists: "+str(derived_filename))
             logging.info("To overwrite existing output, append the --overwrite flag to your command")
-        else:
-            logging.info("Performing postprocessing")
-            postprocessing(args)
-            logging.info("Postprocessing complete, output is: "+str(postprocessed_filename))
+        elif os.path.exists(segmentation_filename):
+            logging.info("Deriving "+model+" segmentation from "+args.m+" segmentation")
+            derive_segmentation(segmentation_filename,args.m,model,derived_filename)
+            logging.info("Derivation complete, output is: "+str(derived_filename))
+
+        ## Predict the coarser model directly and report agreement with the derived segmentation
+        if args.derivecheck and os.path.exists(derived_filename):
+            predicted_filename=derived_filename[:-7]+"_predicted.nii.gz"
+            if args.overwrite or not os.path.exists(predicted_filename):
+                if not os.path.exists(os.path.join(args.o,"temp.nii.gz")):
+                    logging.warning("Temporary input file not found, cannot predict "+model+" model for comparison; use --overwrite to rerun prediction")
+                    continue
+                derivemodel_folder_name,deriveuse_mirroring=nnunetv2_weights(model,nnunetdir)
+                logging.info("Predicting "+model+" model directly for comparison with derived segmentation")
+                predict_case(args=args,model_folder_name=derivemodel_folder_name,folds=folds,
+                    output_filenames=[predicted_filename],use_mirroring=deriveuse_mirroring)
+                logging.info("Prediction complete, output is: "+str(predicted_filename))
+            segmentation_agreement(derived_filename,predicted_filename,model)
+
+    ## Perform postprocessing if desired and segmentation completed
+    ## Derived segmentations are postprocessed using the rules for their own model
+    for model in [args.m]+derivedmodels:
+        model_segmentation_filename=os.path.join(args.o,samplename+"_"+model+".nii.gz")
+        model_postprocessed_filename=model_segmentation_filename[:-7]+"_postprocessed.nii.gz"
+        if not args.nopp and os.path.exists(model_segmentation_filename):
+            ## Avoid overwriting if output exists
+            if not args.overwrite and os.path.exists(model_postprocessed_filename):
+                logging.info("Postprocessed output already exists: "+str(model_postprocessed_filename))
+                logging.info("To overwrite existing output, append the --overwrite flag to your command")
+            else:
+                logging.info("Performing postprocessing for "+model+" model")
+                postprocessing(args,model)
+                logging.info("Postprocessing complete, output is: "+str(model_postprocessed_filename))
 
     ## Perform subsegmentation and produce cortical/trabecular labels
     ## We only allow postprocessed segmentations as input
@@ -244,6 +330,7 @@ def main():
     ## Remove json file clutter and temporary input file
     logging.info("Removing unnecessary json files and temporary input file")
     filedelete(os.path.join(args.o,"temp.nii.gz"))
+    filedelete(os.path.join(args.o,"temp_coarse.nii.gz"))
     filedelete(os.path.join(args.o,"dataset.json"))
     filedelete(os.path.join(args.o,"plans.json"))
     filedelete(os.path.join(args.o,"predict_from_raw_data_args.json"))
@@ -256,7 +343,7 @@ def main():
             reader=sitk.ImageFileReader()
             reader.SetFileName(gzfile)
             image = reader.Execute()
-            image = sitk.DICOMOrient(image, desiredCoordinateOrientation=inputorientation)
+            image = reorient_image(image, inputorientation)
             sitk.WriteImage(image,gzfile)
 
     ## Wrap up
@@ -21,6 +21,8 @@ import pickle
 import numpy as np
 import contextlib
 import sys
+import time
+import logging
 
 ## DummyFile and nostdout() allow nnunet messages to be silenced
 class DummyFile(object):
@@ -37,8 +39,79 @@ def nostdout():
 ## Silently import nnUNetv2 predictor
 with nostdout():
     from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
-    
-def predict_case(args,model_folder_name,folds,output_filenames,use_mirroring):
+
+## Predictor that only runs sliding window tiles near the skeleton found by a coarse first pass
+## localization_mask is a boolean array in the same voxel space as the input file (numpy z,y,x order)
+## Tiles are kept if they lie within localization_margin mm of the mask; everything else is background
+## This overrides private nnUNetPredictor methods, so nnunetv2 is pinned to versions known to have them
+class LocalizedPredictor(nnUNetPredictor):
+    def __init__(self,localization_mask,localization_margin,**kwargs):
+        super().__init__(**kwargs)
+        self.localization_mask=localization_mask
+        self.localization_margin=localization_margin
+        self.data_properties=None
+        self.unpadded_shape=None
+        self.tiles_total=0
+        self.tiles_used=0
+        self.sliding_window_time=0
+
+    ## Keep the preprocessing properties of each case so tiles can be mapped back to the input voxels
+    def _internal_get_data_iterator_from_lists_of_filenames(self,*args,**kwargs):
+        for preprocessed in super()._internal_get_data_iterator_from_lists_of_filenames(*args,**kwargs):
+            self.data_properties=preprocessed['data_properties']
+            yield preprocessed
+
+    def predict_sliding_window_return_logits(self,input_image):
+        self.unpadded_shape=input_image.shape[1:]
+        return super().predict_sliding_window_return_logits(input_image)
+
+    def _internal_get_sliding_window_slicers(self,image_size):
+        if self.data_properties is None or self.unpadded_shape is None:
+            raise RuntimeError("Localized prediction could not get preprocessing details from nnU-Net; "
+                "this nnunetv2 version is not supported, run without --localize")
+        slicers=super()._internal_get_sliding_window_slicers(image_size)
+        ## nnU-Net transposes the input before anything else, so transpose the mask to match
+        mask=self.localization_mask.transpose(self.plans_manager.transpose_forward)
+        kept=[s for s in slicers if self.tile_near_mask(mask,s[1:],image_size)]
+        self.tiles_total=len(slicers)
+        self.tiles_used=len(kept)
+        return kept
+
+    def tile_near_mask(self,mask,tile,image_size):
+        ## nnU-Net crops and then resamples the transposed input, so undo those steps for the tile bounds
+        ## Expanding the tile by the margin is equivalent to dilating the mask with a box of the same size
+        properties=self.data_properties
+        bbox=properties['bbox_used_for_cropping']
+        croppedshape=properties['shape_after_cropping_and_before_resampling']
+        spacing=self.configuration_manager.spacing
+        bounds=[]
+        for axis,sl in enumerate(tile):
+            ## Remove any padding added because the image was smaller than the patch size
+            padding=(image_size[axis]-self.unpadded_shape[axis])//2
+            margin=int(np.ceil(self.localization_margin/spacing[axis]))
+            start=max(sl.start-padding-margin,0)
+            stop=min(sl.stop-padding+margin,self.unpadded_shape[axis])
+            scale=croppedshape[axis]/self.unpadded_shape[axis]
+            start=bbox[axis][0]+int(np.floor(start*scale))
+            stop=min(bbox[axis][0]+int(np.ceil(stop*scale)),bbox[axis][1])
+            if stop<=start:
+                return(False)
+            bounds.append(slice(start,stop))
+        return(bool(mask[tuple(bounds)].any()))
+
+    def _internal_predict_sliding_window_return_logits(self,data,slicers,do_on_device=True):
+        starttime=time.time()
+        predicted_logits=super()._internal_predict_sliding_window_return_logits(data,slicers,do_on_device)
+        self.sliding_window_time+=time.time()-starttime
+        ## Voxels not covered by any tile are 0/0; make them background
+        unvisited=torch.isnan(predicted_logits[0])
+        predicted_logits[:,unvisited]=0
+        predicted_logits[0,unvisited]=1
+        return predicted_logits
+
+## tile_step_size of 1 means tiles do not overlap, which is faster but less accurate at tile edges
+def predict_case(args,model_folder_name,folds,output_filenames,use_mirroring,tile_step_size=0.5,
+                 localization_mask=None,localization_margin=0):
 
     ## Define compute device based on arguments
     if args.d == 'cpu':
@@ -53,10 +126,17 @@ def predict_case(args,model_folder_name,folds,output_filenames,use_mirroring):
         device = torch.device('mps')
         perform_everything_on_device=False
 
-    ## Set up predictor
+    ## Set up predictor; if a localization mask is given, only predict tiles near it
+    if localization_mask is None:
+        predictorclass=nnUNetPredictor
+        localizationargs={}
+    else:
+        predictorclass=LocalizedPredictor
+        localizationargs={"localization_mask":localization_mask,"localization_margin":localization_margin}
     with nostdout():
-        predictor = nnUNetPredictor(
-            tile_step_size=0.5,
+        predictor = predictorclass(
+            **localizationargs,
+            tile_step_size=tile_step_size,
             use_gaussian=True,
             use_mirroring=use_mirroring,
             perform_everything_on_device=perform_everything_on_device,
@@ -78,3 +158,20 @@ def predict_case(args,model_folder_name,folds,output_filenames,use_mirroring):
                                  num_processes_segmentation_export=args.c,
                                  folder_with_segs_from_prev_stage=None, num_parts=1, part_id=0)
 
+    ## Report how much work localization saved and return the estimated time saved in seconds
+    ## Time saved is extrapolated from the time spent on the tiles used, and does not include the localization pass
+    if localization_mask is None:
+        return(None)
+    if predictor.tiles_total==0:
+        raise RuntimeError("Localized prediction did not run through the tile filter; "
+            "this nnunetv2 version is not supported, run without --localize")
+    tiles_skipped=predictor.tiles_total-predictor.tiles_used
+    logging.info("Localized prediction used "+str(predictor.tiles_used)+" of "+str(predictor.tiles_total)+
+        " tiles per fold, skipping "+str(tiles_skipped)+" ("+str(round(100*tiles_skipped/predictor.tiles_total,1))+"%)")
+    if predictor.tiles_used==0:
+        logging.warning("No tiles were near the localized skeleton, so time saved cannot be estimated")
+        return(None)
+    timesaved=predictor.sliding_window_time*tiles_skipped/predictor.tiles_used
+    logging.info("Estimated prediction time saved by skipping tiles: "+str(round(timesaved,1))+" seconds")
+    return(timesaved)
+
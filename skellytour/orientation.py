@@ -0,0 +1,140 @@
+import itertools
+import numpy as np
+import SimpleITK as sitk
+
+## Orientation codes are 3 letter strings (e.g. LPS, RAS) in the DICOM convention used by sitk.DICOMOrient
+## Each letter is the direction that the corresponding image axis increases towards
+## Each physical axis has a positive letter (LPS) and a negative letter (RAI)
+POSITIVE="LPS"
+NEGATIVE="RAI"
+
+def letter_axis(letter):
+    ## Return the physical axis (0,1,2) of a letter and whether it points in the positive direction
+    if letter in POSITIVE:
+        return POSITIVE.index(letter),True
+    return NEGATIVE.index(letter),False
+
+def orientation_plan(fromorientation,toorientation):
+    ## Work out how to get from one orientation to another using only an axis permutation and flips
+    ## permutation[k] is the source image axis that becomes image axis k
+    ## flips[k] is True if image axis k must be reversed after permuting
+    fromaxes=[letter_axis(letter) for letter in fromorientation]
+    permutation=[]
+    flips=[]
+    for letter in toorientation:
+        axis,positive=letter_axis(letter)
+        for i,(fromaxis,frompositive) in enumerate(fromaxes):
+            if fromaxis==axis:
+                permutation.append(i)
+                flips.append(positive!=frompositive)
+                break
+    return(tuple(permutation),tuple(flips))
+
+def all_orientations():
+    ## All 48 valid orientation codes; 6 axis orders with 8 combinations of directions
+    codes=[]
+    for order in itertools.permutations(range(3)):
+        for signs in itertools.product((True,False),repeat=3):
+            codes.append("".join(POSITIVE[axis] if sign else NEGATIVE[axis] for axis,sign in zip(order,signs)))
+    return(codes)
+
+class OrientedArray:
+    ## A numpy array in sitk axis order (z,y,x) plus the geometry needed to turn it back into an image
+    ## Reorienting returns NumPy views rather than copies; a contiguous copy is only made by to_image()
+    def __init__(self,nparray,spacing,origin,direction,orientation=None):
+        self.nparray=nparray
+        self.spacing=tuple(spacing)
+        self.origin=tuple(origin)
+        self.direction=tuple(direction)
+        if orientation is None:
+            orientation=sitk.DICOMOrientImageFilter_GetOrientationFromDirectionCosines(self.direction)
+        self.orientation=orientation
+
+    @classmethod
+    def from_image(cls,image):
+        ## GetArrayViewFromImage avoids a copy; the view is read-only and only valid while image is alive
+        ## so keep a reference to the image alongside it
+        oriented=cls(sitk.GetArrayViewFromImage(image),image.GetSpacing(),image.GetOrigin(),image.GetDirection())
+        oriented.source=image
+        return(oriented)
+
+    def with_array(self,nparray):
+        ## Attach a new array (e.g. a processed label map) to the same geometry
+        return(OrientedArray(nparray,self.spacing,self.origin,self.direction,self.orientation))
+
+    @property
+    def size(self):
+        ## Image size in sitk (x,y,z) order
+        return(tuple(reversed(self.nparray.shape)))
+
+    def reorient(self,toorientation):
+        ## Equivalent to sitk.DICOMOrient, but permutes and flips the array as a view and recalculates the geometry
+        if toorientation==self.orientation:
+            return(self)
+        permutation,flips=orientation_plan(self.orientation,toorientation)
+        size=self.size
+
+        ## Direction columns are the physical direction of each image axis
+        olddirection=np.array(self.direction,dtype=float).reshape(3,3)
+        newdirection=np.zeros((3,3))
+        newspacing=[]
+        ## The new origin is the physical position of the voxel that becomes index (0,0,0)
+        cornerindex=np.zeros(3)
+        for k,(i,flip) in enumerate(zip(permutation,flips)):
+            newdirection[:,k]=-olddirection[:,i] if flip else olddirection[:,i]
+            newspacing.append(self.spacing[i])
+            if flip:
+                cornerindex[i]=size[i]-1
+        neworigin=np.array(self.origin)+olddirection.dot(cornerindex*np.array(self.spacing))
+
+        ## Numpy axes are in reverse order to sitk axes
+        nparray=np.transpose(self.nparray,[2-permutation[2-j] for j in range(3)])
+        slices=tuple(slice(None,None,-1) if flips[2-j] else slice(None) for j in range(3))
+        nparray=nparray[slices]
+
+        oriented=OrientedArray(nparray,newspacing,neworigin,newdirection.flatten(),toorientation)
+        if hasattr(self,"source"):
+            oriented.source=self.source
+        return(oriented)
+
+    def to_image(self):
+        ## Materialise a contiguous copy of the array and set the tracked geometry
+        image=sitk.GetImageFromArray(np.ascontiguousarray(self.nparray))
+        image.SetSpacing(self.spacing)
+        image.SetOrigin(tuple(float(x) for x in self.origin))
+        image.SetDirection(tuple(float(x) for x in self.direction))
+        return(image)
+
+def reorient_image(image,toorientation):
+    ## Drop-in replacement for sitk.DICOMOrient(image,desiredCoordinateOrientation=toorientation)
+    return(OrientedArray.from_image(image).reorient(toorientation).to_image())
+
+def check_orientations(size=(4,5,6),tolerance=1e-6):
+    ## Compare reorient_image() against sitk.DICOMOrient for every pair of the 48 orientation codes
+    ## Returns a list of (from,to) pairs that do not match; an empty list means everything agrees
+    rng=np.random.default_rng(0)
+    nparray=rng.integers(0,60,size=tuple(reversed(size))).astype(np.uint8)
+    base=sitk.GetImageFromArray(nparray)
+    base.SetSpacing((0.8,1.1,2.5))
+    base.SetOrigin((-12.5,30.0,101.0))
+    mismatches=[]
+    for fromorientation in all_orientations():
+        image=sitk.DICOMOrient(base,desiredCoordinateOrientation=fromorientation)
+        for toorientation in all_orientations():
+            expected=sitk.DICOMOrient(image,desiredCoordinateOrientation=toorientation)
+            observed=reorient_image(image,toorientation)
+            same=(expected.GetSize()==observed.GetSize()
+                and np.allclose(expected.GetSpacing(),observed.GetSpacing(),atol=tolerance)
+                and np.allclose(expected.GetOrigin(),observed.GetOrigin(),atol=tolerance)
+                and np.allclose(expected.GetDirection(),observed.GetDirection(),atol=tolerance)
+                and np.array_equal(sitk.GetArrayViewFromImage(expected),sitk.GetArrayViewFromImage(observed)))
+            if not same:
+                mismatches.append((fromorientation,toorientation))
+    return(mismatches)
+
+## Running this module directly checks the orientation code against sitk.DICOMOrient
+if __name__ == '__main__':
+    mismatches=check_orientations()
+    print(str(len(all_orientations()))+" orientation codes checked, "+str(len(mismatches))+" mismatches")
+    for mismatch in mismatches:
+        print("Mismatch: "+mismatch[0]+" to "+mismatch[1])
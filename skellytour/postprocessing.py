@@ -4,12 +4,16 @@ import numpy as np
 import copy
 import logging
 from skimage import measure
+from skellytour.orientation import OrientedArray
 
-def postprocessing(args):
+## model defaults to the model used for prediction, but can be given for segmentations derived from it
+def postprocessing(args,model=None):
+    if model is None:
+        model=args.m
 
     ## Define some variables for input/output files
     samplename=os.path.basename(args.i)[:-7]
-    segmentation_filename=os.path.join(args.o,samplename+"_"+args.m+".nii.gz")
+    segmentation_filename=os.path.join(args.o,samplename+"_"+model+".nii.gz")
     postprocessed_filename=segmentation_filename[:-7]+"_postprocessed.nii.gz"
 
     ## Minimum island size to keep is 1000 mm3
@@ -17,15 +21,15 @@ def postprocessing(args):
 
     ## Postprocessing depends on the model used for prediction
     ## Define lists of labels and what to do with them
-    if args.m=="low":
+    if model=="low":
         largestonly=[1,2,3,4,5,6,7,8,9,10,11,14,15,16]
         ribs=[12,13]
         keepall=[17]
-    if args.m=="medium":
+    if model=="medium":
         largestonly=[1,2,3,4,5,6,7,8,9,10,11,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37]
         ribs=[12,13]
         keepall=[38]
-    if args.m=="high":
+    if model=="high":
         largestonly=list(range(1,60))
         keepall=[60]
 
@@ -33,12 +37,13 @@ def postprocessing(args):
     reader=sitk.ImageFileReader()
     reader.SetFileName(segmentation_filename)
     image = reader.Execute()
-    inputorientation = sitk.DICOMOrientImageFilter_GetOrientationFromDirectionCosines(image.GetDirection())
-    image = sitk.DICOMOrient(image, desiredCoordinateOrientation='RAS')
-    narr=sitk.GetArrayFromImage(image)
+    inputimage = OrientedArray.from_image(image)
+    inputorientation = inputimage.orientation
+    rasimage = inputimage.reorient('RAS')
+    narr=rasimage.nparray
 
     ## Get size in mm of each voxel dimension and calculate minimum number of voxels to keep an island
-    vspacing = image.GetSpacing()
+    vspacing = rasimage.spacing
     voxelvolume=vspacing[0]*vspacing[1]*vspacing[2]
     minvoxels=int(np.round(minisland/voxelvolume))
 
@@ -98,11 +103,7 @@ def postprocessing(args):
                     finalnarr[all_labels==sizeorder[i]]=seglabel
 
     ## Write postprocessed segmentation
-    finalimage = sitk.GetImageFromArray(finalnarr)
-    finalimage.SetSpacing(image.GetSpacing())
-    finalimage.SetOrigin(image.GetOrigin())
-    finalimage.SetDirection(image.GetDirection())
-    finalimage = sitk.DICOMOrient(finalimage, desiredCoordinateOrientation=inputorientation)
+    finalimage = rasimage.with_array(finalnarr).reorient(inputorientation).to_image()
     sitk.WriteImage(finalimage,postprocessed_filename)
 
 
@@ -2,6 +2,7 @@
 # Import packages
 import SimpleITK as sitk
 import numpy as np
+from skellytour.orientation import OrientedArray
 
 ## Three inputs; 1.) raw subsegmentation 2.) postprocessed bone segmentation 3.) output filename
 def subsegpostprocessing(fname, boneseg_fname, outpath):
@@ -100,31 +101,32 @@ class Nifti(sitk.SimpleITK.Image):
         # This will be a 3 letter string of LR/PA/IS in some order,...
         # ... usually LPS or RAS
         # I think our whole body scans are LPS, but you can check
-        self.inputorientation = sitk.DICOMOrientImageFilter_GetOrientationFromDirectionCosines(
-            self.image.GetDirection())
-        # Reorient to RAS
-        self.image = sitk.DICOMOrient(self.image,
-                                      desiredCoordinateOrientation='RAS')
+        inputimage = OrientedArray.from_image(self.image)
+        self.inputorientation = inputimage.orientation
+        # Reorient to RAS; this is a view of the array plus RAS geometry, ...
+        # ...no image data is copied
+        self.oriented = inputimage.reorient('RAS')
 
     def define_dims(self):
         # Find image dimensions and real size of volume in mm
         # Volume of a voxel in mm3 is vspacing[0]*vspacing[1]*vspacing[2]
         self.LR, self.PA, self.IS = 0, 1, 2  # RAS format labels if you ...
         # ... want to access objects e.g. vsizes[0]
-        self.vsizes = self.image.GetSize()  # num of pixels in each direction
-        self.vspacing = self.image.GetSpacing()  # actual size in mm
+        self.vsizes = self.oriented.size  # num of pixels in each direction
+        self.vspacing = self.oriented.spacing  # actual size in mm
 
     def to_numpy_array(self):
-        # Convert sitk image to numpy array
-        # This is because the original image object is immutable, ...
-        # ...so we need a deep copy of it to do anything with it
+        # nparray is a read-only RAS view of the image data, not a copy; ...
+        # ...self.image owns the buffer and keeps the view valid
+        # Callers must np.copy it before writing to it, ...
+        # ...as subsegpostprocessing does
         # This inverts the axis order: RAS to SAR
         # The order is correct, but I can't say 100% that ...
         # ...I've got the direction correct
         # 1st is IS: values increase inferior to superior
         # 2nd is PA: values increase posterior to anterior
         # 3rd is LR: values increase left to right
-        self.nparray = sitk.GetArrayFromImage(self.image)
+        self.nparray = self.oriented.nparray
 
     def add_labels(self, label_fname):
         self.label = Nifti(label_fname)
@@ -164,12 +166,8 @@ class Nifti(sitk.SimpleITK.Image):
         # Create a new image object from the numpy array, ...
         # ...set its metadata and orientation to
         # the same values as the original input data
-        mimage = sitk.GetImageFromArray(nparray)
-        mimage.SetSpacing(self.image.GetSpacing())
-        mimage.SetOrigin(self.image.GetOrigin())
-        mimage.SetDirection(self.image.GetDirection())
-        mimage = sitk.DICOMOrient(mimage,
-                                  desiredCoordinateOrientation=self.inputorientation)
+        mimage = self.oriented.with_array(nparray).reorient(
+            self.inputorientation).to_image()
         # logging.debug('New image orientation is {}'.format(mimage.GetOrientation()))
         return mimage
 